@@ -1,27 +1,84 @@
-import streamlit as st
-import ollama
-import subprocess
-import time
-import re
+import asyncio
+import concurrent.futures
+import hashlib
 import json
-import yaml
+import os
+import re
+import subprocess
 import textwrap
+import threading
+import time
+from typing import Optional
+
+import ollama
+import streamlit as st
+
+try:
+    import apply_fix_to_github as gh
+except ImportError:
+    gh = None  # GitHub integration is optional; buttons degrade to an error
 
 # --- CONFIGURATION ---
 LLM_MODEL = 'gemma3'  # Change to your model (e.g., 'codellama', 'gemma2:2b')
 OLLAMA_HOST = 'http://localhost:11434'
+KEEP_ALIVE = '30m'  # pin the model in memory between reviews (no reload cost)
+CACHE_DIR = '.codegod_cache'  # persistent review cache, survives restarts
 
 # --- Initialize Ollama Client ---
+@st.cache_resource(show_spinner=False)
+def get_ollama_client():
+    """Create the Ollama client once per process, with a keep-alive connection pool.
+
+    Streamlit reruns the whole script on every widget interaction, so an
+    unguarded module-level client would reconnect and re-probe Ollama on
+    every click. st.cache_resource keeps a single pooled client (and its
+    one-time connection test) alive for the app's lifetime.
+    """
+    c = ollama.Client(host=OLLAMA_HOST, timeout=120.0)
+    c.list()  # Test connection (once, not per rerun)
+    # Warm up: an empty generate forces the model weights into memory now,
+    # so the first user-initiated review doesn't pay the multi-second load.
+    c.generate(model=LLM_MODEL, prompt='', keep_alive=KEEP_ALIVE)
+    return c
+
 try:
-    client = ollama.Client(host=OLLAMA_HOST)
-    # Test connection
-    client.list()
+    get_ollama_client()  # fail fast with a friendly message if Ollama is down
 except Exception as e:
     st.error(f"Error connecting to Ollama: Ensure Ollama is running. Details: {e}")
     st.info("Start Ollama with: `ollama serve`")
     st.stop()
 
 # --- Load Custom Guidelines ---
+@st.cache_data(ttl=3600, show_spinner=False)
+def _parse_guidelines(content: bytes, filename: str) -> Optional[str]:
+    """Parse guideline bytes (JSON or YAML) into a formatted rule string.
+
+    Cached on the raw bytes so reruns with an unchanged upload skip the
+    parse entirely. Returns None when the document isn't a string or a
+    list of rules; parse errors surface as ValueError.
+    """
+    text = content.decode("utf-8")
+    if filename.endswith('.json'):
+        data = json.loads(text)
+    else:
+        # Deferred import: pyyaml costs tens of ms on cold start and only
+        # sessions that actually upload a YAML file need it.
+        import yaml
+        try:
+            from yaml import CSafeLoader as Loader  # libyaml, ~10x faster
+        except ImportError:
+            from yaml import SafeLoader as Loader
+        try:
+            data = yaml.load(text, Loader=Loader)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e)) from e
+
+    if isinstance(data, str):
+        return data.strip()
+    elif isinstance(data, list):
+        return "\n".join(f"- {rule}".strip() for rule in data if rule)
+    return None
+
 def load_guidelines(uploaded_file) -> str:
     """Load custom coding guidelines from JSON/YAML. Returns formatted string."""
     if uploaded_file is None:
@@ -35,42 +92,36 @@ def load_guidelines(uploaded_file) -> str:
         """
         return default.strip()
 
-    try:
-        content = uploaded_file.read().decode("utf-8")
-        filename = uploaded_file.name.lower()
-
-        if filename.endswith('.json'):
-            data = json.loads(content)
-        elif filename.endswith(('.yaml', '.yml')):
-            data = yaml.safe_load(content)
-        else:
-            st.warning("Unsupported file type. Use .json, .yaml, or .yml")
-            return ""
-
-        if isinstance(data, str):
-            return data.strip()
-        elif isinstance(data, list):
-            return "\n".join(f"- {rule}".strip() for rule in data if rule)
-        else:
-            st.warning("File must contain a string or list of rules.")
-            return ""
+    filename = uploaded_file.name.lower()
+    if not filename.endswith(('.json', '.yaml', '.yml')):
+        st.warning("Unsupported file type. Use .json, .yaml, or .yml")
+        return ""
 
-    except Exception as e:
+    try:
+        parsed = _parse_guidelines(uploaded_file.getvalue(), filename)
+    except (UnicodeDecodeError, ValueError) as e:
+        # json.JSONDecodeError is a ValueError; YAML errors are re-raised
+        # as ValueError by _parse_guidelines.
         st.error(f"Failed to parse guidelines: {e}")
         return ""
 
-# --- Run Code Review with LLM (UPDATED for Cost/Resource Tracking) ---
-def run_code_review(code_content: str) -> dict:
-    """Analyzes git diff using LLM with custom guidelines and tracks resource usage."""
-    custom_guidelines = st.session_state.get('custom_guidelines', '')
-    guidelines_block = f"\n\n**CUSTOM CODING GUIDELINES**:\n{custom_guidelines}\n" if custom_guidelines else ""
-
-    SYSTEM_PROMPT = f"""
+    if parsed is None:
+        st.warning("File must contain a string or list of rules.")
+        return ""
+    return parsed
+
+# --- System Prompt ---
+# Static — built once at import. Keeping the base prompt byte-identical
+# across calls lets Ollama reuse its prompt-prefix KV cache; the custom
+# guidelines travel in a separate system message instead of being
+# interpolated into this block. Dedented once at import: the Python
+# indentation would otherwise ship ~4 whitespace tokens per line to the
+# model and slow prefill for nothing.
+BASE_SYSTEM_PROMPT = textwrap.dedent("""
     You are an expert Senior Software Engineer specializing in highly concise, actionable, and structured code reviews.
     Analyze the provided git diff. Focus ONLY on the changes and their immediate context.
 
     **GUIDELINE AWARENESS CHECK**: Prioritize checking for violations of **PEP8** (especially naming conventions, maximum 79-character line length, and whitespace rules) and general readability standards.
-    {guidelines_block}
 
     Your response MUST be in clear Markdown, except number 3) where the output should be displayed in the corresponding programming language markdown and follow this precise structure:
 
@@ -87,52 +138,322 @@ def run_code_review(code_content: str) -> dict:
         *All code must be enclosed in a Markdown code block with the language identifier specified (e.g., ```python ... ```), with proper coloring and syntax.
         * Format for fix: Start the line with `[FIX_START]` and end the block with `[FIX_END]`.
         
-    4.  **Documentation Suggestions**: List every file that needs an update (e.g., `README.md`, `docs/api.md`) followed by the exact markdown text to add/insert.  
+    4.  **Documentation Suggestions**: List every file that needs an update (e.g., `README.md`, `docs/api.md`) followed by the exact markdown text to add/insert.
         If nothing is required, write **exactly**: `Documentation Suggestions: None needed.`
+    """).strip()
+BASE_SYSTEM_PROMPT = re.sub(r'\n{3,}', '\n\n', BASE_SYSTEM_PROMPT)
+
+_GUIDELINES_HEADER = "**CUSTOM CODING GUIDELINES**:\n"
+
+# Prompt-eval cost scales with prompt tokens, so oversized diffs are
+# trimmed to a token budget before they reach the model.
+MAX_INPUT_TOKENS = 4096
+
+def _approx_tokens(s: str) -> int:
+    """Cheap token estimate: ~4 characters per token for English/code."""
+    return len(s) // 4
+
+# Cost-panel accounting: tiktoken's Rust BPE when available (accurate and
+# fast), otherwise the chars/4 heuristic. Optional on purpose — the app
+# works without it.
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _ENCODER = None
+
+def _count_tokens(s: str) -> int:
+    if _ENCODER is not None:
+        return len(_ENCODER.encode(s))
+    return _approx_tokens(s)
+
+_BASE_PROMPT_TOKENS = _count_tokens(BASE_SYSTEM_PROMPT)  # static part, once
+
+def _truncate_diff(diff: str, max_tokens: int = MAX_INPUT_TOKENS) -> str:
+    """Trim an oversized diff to roughly max_tokens.
+
+    Changed lines matter more than context: when over budget, context
+    lines are dropped first (hunk and file headers are kept so the LLM
+    still sees where changes live), and only then are trailing changed
+    lines cut with a visible sentinel.
+    """
+    if _approx_tokens(diff) <= max_tokens:
+        return diff
+    budget_chars = max_tokens * 4
+    kept = []
+    used = 0
+    for line in diff.splitlines(keepends=True):
+        keep = line[:1] in '+-' or line.startswith(('@@', 'diff --git', 'index '))
+        if not keep:
+            continue
+        if used + len(line) > budget_chars:
+            kept.append("\n[... diff truncated to fit the model context ...]\n")
+            break
+        kept.append(line)
+        used += len(line)
+    return ''.join(kept)
+
+def _is_trivial_diff(diff: str) -> bool:
+    """True when the staged changes are whitespace/comment noise that
+    doesn't warrant an LLM round-trip (a multi-second call saved)."""
+    changed = _CHANGED_LINE_RE.findall(diff)
+    if not changed:
+        return False  # nothing recognisable — let the LLM look at it
+    if sum(len(ln) for ln in changed) < 40:
+        return True
+    return len(changed) <= 3 and all(
+        not ln.strip() or ln.lstrip().startswith(('#', '//'))
+        for ln in changed
+    )
+
+# Multi-file diffs are split per file and reviewed concurrently.
+_FILE_SPLIT_RE = re.compile(r'(?=^diff --git )', re.MULTILINE)
+_DIFF_HEADER_RE = re.compile(r'^diff --git a/(\S+)', re.MULTILINE)
+
+def _diff_filename(file_diff: str) -> str:
+    match = _DIFF_HEADER_RE.search(file_diff)
+    return match.group(1) if match else "unknown file"
+
+BATCH_WINDOW_MS = 100
+
+class _ReviewBatcher:
+    """Collects concurrent chat requests and dispatches each batch together.
+
+    In team use, several Review clicks (or the per-file requests of one
+    multi-file diff) can land within milliseconds of each other. Instead
+    of each firing its own request chain, submissions pile up for a short
+    debounce window and go out in a single asyncio.gather, letting Ollama
+    overlap their prompt-eval phases across its parallel workers (set
+    OLLAMA_NUM_PARALLEL in the server's environment to allow more than
+    one in flight). Callers block on the returned future.
     """
 
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS):
+        self._window = window_ms / 1000.0
+        self._pending = []  # (messages, future) pairs
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, messages: list) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending.append((messages, future))
+        self._wake.set()
+        return future
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self._window)  # debounce: let near-simultaneous requests pile up
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._wake.clear()
+            if batch:
+                asyncio.run(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        aclient = ollama.AsyncClient(host=OLLAMA_HOST, timeout=120.0)
+
+        async def one(messages, future):
+            try:
+                response = await aclient.chat(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    options={'temperature': 0.15, 'seed': 42},
+                    keep_alive=KEEP_ALIVE,
+                )
+                future.set_result(response['message']['content'])
+            except Exception as e:
+                future.set_exception(e)
+
+        await asyncio.gather(*(one(m, f) for m, f in batch))
+
+@st.cache_resource(show_spinner=False)
+def get_review_batcher() -> _ReviewBatcher:
+    """One batching worker shared by every session of this process."""
+    return _ReviewBatcher()
+
+# --- Run Code Review with LLM (UPDATED for Cost/Resource Tracking) ---
+def run_code_review(code_content: str, force_refresh: bool = False) -> dict:
+    """Analyzes git diff using LLM with custom guidelines and tracks resource usage."""
+    custom_guidelines = st.session_state.get('custom_guidelines', '')
+    code_content = _truncate_diff(code_content)
+
+    # Fast path: don't spend seconds of LLM time on noise changes.
+    if _is_trivial_diff(code_content):
+        return {
+            'review': "**Verdict: Approved** — trivial whitespace/comment change. Effort: Low.",
+            'time': 0.0,
+            'input_chars': 0,
+            'output_chars': 0,
+            'trivial': True,
+        }
+
     user_content = f"Review this git diff:\n\n{code_content}"
-    
-    # COST MANAGEMENT: Track input size
-    input_size_chars = len(SYSTEM_PROMPT) + len(user_content)
 
-    messages = [
-        {'role': 'system', 'content': SYSTEM_PROMPT},
-        {'role': 'user', 'content': user_content},
-    ]
+    messages = [{'role': 'system', 'content': BASE_SYSTEM_PROMPT}]
+    if custom_guidelines:
+        messages.append({
+            'role': 'system',
+            'content': _GUIDELINES_HEADER + custom_guidelines
+        })
+    messages.append({'role': 'user', 'content': user_content})
+
+    # COST MANAGEMENT: Track input size. The static prompt's token count
+    # is precomputed; only the per-request delta is encoded here.
+    input_size_chars = sum(len(m['content']) for m in messages)
+    input_tokens = _BASE_PROMPT_TOKENS + sum(
+        _count_tokens(m['content']) for m in messages[1:]
+    )
+
+    # COST MANAGEMENT: Content-addressed cache. The call is deterministic
+    # (temperature=0.15, seed=42), so an identical model+prompt+diff always
+    # produces the same review — serve it from cache instead of re-paying
+    # the full Ollama prompt-eval + decode cost.
+    cache_key = hashlib.sha256(
+        f"{LLM_MODEL}|{BASE_SYSTEM_PROMPT}|{custom_guidelines}|{code_content}".encode("utf-8")
+    ).hexdigest()
+    review_cache = st.session_state.setdefault('review_cache', {})
+    if not force_refresh and cache_key in review_cache:
+        return {**review_cache[cache_key], 'time': 0.0, 'cached': True}
+
+    # Second tier: on-disk cache, so identical diffs reviewed before a
+    # process restart (or by another session) still skip the LLM.
+    cache_file = os.path.join(CACHE_DIR, cache_key + '.md')
+    if not force_refresh and os.path.exists(cache_file):
+        try:
+            with open(cache_file, encoding='utf-8') as f:
+                cached_review = f.read()
+        except OSError:
+            cached_review = None  # unreadable entry — fall through to the LLM
+        if cached_review:
+            result = {
+                'review': cached_review,
+                'time': 0.0,
+                'input_chars': input_size_chars,
+                'output_chars': len(cached_review),
+                'input_tokens': input_tokens,
+                'output_tokens': _count_tokens(cached_review),
+            }
+            review_cache[cache_key] = result
+            return {**result, 'cached': True}
 
     start_time = time.time()
+    # Stream tokens into a placeholder as they arrive so the user sees
+    # progress immediately instead of a spinner for the whole generation.
+    placeholder = st.empty()
     try:
-        response = client.chat(
-            model=LLM_MODEL,
-            messages=messages,
-            options={'temperature': 0.15, 'seed': 42}
-        )
+        file_diffs = [d for d in _FILE_SPLIT_RE.split(code_content) if d.strip()]
+        if len(file_diffs) > 1:
+            # One request per file through the shared batcher; merged into
+            # per-file sections.
+            placeholder.markdown(f"Reviewing {len(file_diffs)} files in parallel…")
+            batcher = get_review_batcher()
+            futures = [
+                batcher.submit(messages[:-1] + [
+                    {'role': 'user', 'content': f"Review this git diff:\n\n{d}"}
+                ])
+                for d in file_diffs
+            ]
+            reviews = [f.result(timeout=300) for f in futures]
+            buffer = "\n\n---\n\n".join(
+                f"### `{_diff_filename(d)}`\n\n{r}"
+                for d, r in zip(file_diffs, reviews)
+            )
+            placeholder.empty()
+        else:
+            buffer = ""
+            last_render = 0.0
+            stream = get_ollama_client().chat(
+                model=LLM_MODEL,
+                messages=messages,
+                options={'temperature': 0.15, 'seed': 42},
+                keep_alive=KEEP_ALIVE,
+                stream=True
+            )
+            for chunk in stream:
+                buffer += chunk['message']['content']
+                now = time.time()
+                if now - last_render > 0.05:  # throttle Streamlit rerenders
+                    placeholder.markdown(buffer + "▌")
+                    last_render = now
+            placeholder.empty()  # final render happens in main()
         latency = time.time() - start_time
-        review_text = response['message']['content']
-        
+        review_text = buffer
+
+
         # COST MANAGEMENT: Track output size
         output_size_chars = len(review_text)
 
-        return {
-            'review': review_text, 
+        result = {
+            'review': review_text,
             'time': latency,
             'input_chars': input_size_chars,
-            'output_chars': output_size_chars
+            'output_chars': output_size_chars,
+            'input_tokens': input_tokens,
+            'output_tokens': _count_tokens(review_text),
         }
+        review_cache[cache_key] = result
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                f.write(review_text)
+        except OSError:
+            pass  # the disk tier is best-effort
+        return result
     except Exception as e:
+        placeholder.empty()  # drop any partially streamed output
         # Ensure we return the input size even on failure
         return {'review': f"LLM Review Failed: {e}", 'time': 0, 'input_chars': input_size_chars, 'output_chars': 0}
 
 # --- Get Staged Git Changes ---
+MAX_DIFF_BYTES = 512 * 1024  # cap what we buffer and ship to the LLM
+MAX_DISPLAY_BYTES = 64 * 1024  # cap what the diff viewer renders per rerun
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _staged_diff(index_mtime: float, head_mtime: float) -> str:
+    """Stream `git diff --staged` up to MAX_DIFF_BYTES. Keyed on the git
+    index and HEAD mtimes so Streamlit reruns reuse the cached diff and
+    only real staging events or branch switches pay the subprocess
+    fork/exec. Reading the pipe in chunks keeps a 40k-line diff from
+    being buffered whole, and the cap protects the LLM context window."""
+    proc = subprocess.Popen(
+        ['git', 'diff', '--staged', '--no-color', '--no-ext-diff'],
+        stdout=subprocess.PIPE, text=True
+    )
+    chunks = []
+    total = 0
+    truncated = False
+    for chunk in iter(lambda: proc.stdout.read(65536), ''):
+        total += len(chunk)
+        if total >= MAX_DIFF_BYTES:
+            chunks.append(chunk[:MAX_DIFF_BYTES - total or None])
+            truncated = True
+            break
+        chunks.append(chunk)
+    if truncated:
+        proc.kill()
+    proc.wait()
+    if proc.returncode != 0 and not truncated:
+        raise subprocess.CalledProcessError(proc.returncode, 'git diff --staged')
+    diff = ''.join(chunks)
+    if truncated:
+        diff += "\n[... diff truncated at 512KB ...]"
+    return diff
+
 def get_staged_changes() -> str:
     """Fetches `git diff --staged` output."""
     try:
-        result = subprocess.run(
-            ['git', 'diff', '--staged'],
-            capture_output=True, text=True, check=True
-        )
-        return result.stdout
+        index_mtime = os.path.getmtime('.git/index')
+    except OSError:
+        index_mtime = 0.0  # no index yet — empty repo
+    try:
+        head_mtime = os.path.getmtime('.git/HEAD')
+    except OSError:
+        head_mtime = 0.0
+    try:
+        return _staged_diff(index_mtime, head_mtime)
     except subprocess.CalledProcessError:
         return ""
     except FileNotFoundError:
@@ -140,41 +461,194 @@ def get_staged_changes() -> str:
         return ""
 
 # Extract Auto-Fix Code
+# Compiled once at import; the old inline pattern also had a stray `.*?`
+# before the language capture that made the match backtrack pointlessly.
+_FIX_RE = re.compile(r'\[FIX_START\]\s*```[ \t]*(\w*)[ \t]*\n(.*?)\s*```\s*\[FIX_END\]', re.DOTALL)
+_SENTINEL_RE = re.compile(r'\[FIX_(?:START|END)\]')
+# Added lines of a unified diff ('+' but not the '+++' file header).
+_ADDED_LINE_RE = re.compile(r'(?m)^\+(?!\+\+)(.*)$')
+# Changed lines (either sign, excluding the +++/--- file headers).
+_CHANGED_LINE_RE = re.compile(r'(?m)^[+-](?!\+\+|--)(.*)$')
+
 def extract_fixes(review_text: str) -> str:
     """Extract code between [FIX_START] and [FIX_END]."""
-    match = re.search(r'\[FIX_START\]\s*```.*?(\w*)\n(.*?)\s*```\s*\[FIX_END\]', review_text, re.DOTALL)
+    match = _FIX_RE.search(review_text)
     return match.group(2).strip() if match else ""
 
 # Documentation Suggestions
+# Compiled once at import, like the fix-block patterns above.
+_DOC_RE = re.compile(
+    r"Documentation\s+Suggestions\s*:\s*(.+?)(?=(\n\d+\.\s|\Z))",
+    re.DOTALL | re.IGNORECASE,
+)
+# One entry per `file: content…` span, continuation lines included up to
+# the next file line — a single C-level scan instead of a Python loop.
+_DOC_ENTRY_RE = re.compile(
+    r"^\s*([-\w./]+)\s*[:\-]\s*(.*?)(?=^\s*[-\w./]+\s*[:\-]|\Z)",
+    re.MULTILINE | re.DOTALL,
+)
+
 def extract_doc_suggestions(review_text: str) -> list[dict]:
     """
     Pulls the **Documentation Suggestions** section from the LLM output.
     Returns a list of dicts: [{'file': 'README.md', 'content': '…'}, …]
     """
-    pattern = r"(?i)Documentation\s+Suggestions\s*:\s*(.+?)(?=(\n\d+\.\s|\Z))"
-    raw = re.search(pattern, review_text, re.DOTALL)
+    raw = _DOC_RE.search(review_text)
     if not raw:
         return []
 
-    suggestions = []
-    lines = raw.group(1).strip().splitlines()
-    current_file = None
-    current_block = []
+    return [
+        {
+            "file": match.group(1).strip(),
+            "content": "\n".join(
+                line.strip() for line in match.group(2).splitlines() if line.strip()
+            ),
+        }
+        for match in _DOC_ENTRY_RE.finditer(raw.group(1))
+    ]
 
-    for line in lines:
-        file_match = re.match(r"^\s*([-\w./]+)\s*[:\-]\s*(.*)", line)
-        if file_match:
-            if current_file:
-                suggestions.append({"file": current_file, "content": "\n".join(current_block).strip()})
-            current_file = file_match.group(1).strip()
-            current_block = [file_match.group(2).strip()] if file_match.group(2) else []
-        elif current_file and line.strip():
-            current_block.append(line.strip())
+@st.fragment
+def _render_review_panel(review_data: dict, diff_content: str):
+    """Render the review results, fix actions, and doc suggestions.
 
-    if current_file:
-        suggestions.append({"file": current_file, "content": "\n".join(current_block).strip()})
+    A fragment so that clicks on the buttons inside (Apply to GitHub,
+    Show Manual Guide, docs actions) rerun only this block instead of
+    the whole script — no re-probe of git or Ollama per click.
+    """
+
+    st.markdown("---")
+
+    if review_data.get('cached'):
+        st.caption("♻️ Cache hit — identical diff already reviewed this session.")
 
-    return suggestions
+    # COST MANAGEMENT: Display Resource Metrics (UPDATED)
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        st.metric("Review Time", f"{review_data['time']:.2f}s")
+    
+    with col2:
+        # Accurate BPE count when tiktoken is installed, else ~4 chars/token
+        input_tokens = review_data.get('input_tokens', review_data['input_chars'] // 4)
+        st.metric("Prompt Size (est.)", f"{input_tokens:,} tokens")
+
+    with col3:
+        output_tokens = review_data.get('output_tokens', review_data['output_chars'] // 4)
+        st.metric("Response Size (est.)", f"{output_tokens:,} tokens")
+        
+    with col4:
+        st.metric("Total Characters", f"{(review_data['input_chars'] + review_data['output_chars']):,}")
+        
+    st.markdown("---")
+    
+    st.subheader("LLM Review")
+    # Single linear scan instead of two full replace passes.
+    clean_review = _SENTINEL_RE.sub('', review_data['review'])
+    st.markdown(clean_review)
+
+    # --- Auto-Fix Section ---
+    fix_code = extract_fixes(review_data['review'])
+    if fix_code:
+        st.markdown("---")
+        if 'show_fix' not in st.session_state:
+            st.session_state.show_fix = False
+
+        col_apply, col_guide = st.columns([1, 1])
+        with col_apply:
+            if st.button("Apply to GitHub (Auto-PR)", type="primary", use_container_width=True):
+                with st.spinner("Creating PR on GitHub..."):
+                    try:
+                        # Extract added lines from the diff in one
+                        # C-level regex scan — no Python-per-line
+                        # branching or intermediate line lists.
+                        # strip('\n') only: leading whitespace is
+                        # significant for the exact-match replace
+                        # on GitHub's side.
+                        old_code = '\n'.join(
+                            _ADDED_LINE_RE.findall(diff_content)
+                        ).strip('\n')
+
+                        if gh is None:
+                            st.error("GitHub integration unavailable: apply_fix_to_github failed to import.")
+                        elif not old_code:
+                            st.error("Could not detect modified code block.")
+                        else:
+                            pr = gh.create_pr_with_fix(
+                                repo=st.secrets.get("GITHUB_REPO", "your-username/your-repo"),
+                                branch=f"ai-fix-{int(time.time())}",
+                                file_path="app.py",
+                                old_code=old_code,
+                                new_code=fix_code,
+                                commit_message="fix: AI-suggested code improvement",
+                                pr_title="AI Fix: Apply LLM suggestion",
+                                pr_body=f"Automatically applied fix from AI code review.\n\n**Original diff**:\n```diff\n{diff_content}\n```",
+                            )
+                            pr_url = pr["html_url"]
+                            st.success(f"PR created! [View on GitHub]({pr_url})")
+                    except Exception as e:
+                        st.error(f"Failed to create PR: {e}")
+
+        with col_guide:
+            if st.button("Show Manual Guide"):
+                st.session_state.show_fix = not st.session_state.show_fix
+
+        if st.session_state.show_fix:
+            with st.expander("Manual Fix Guide", expanded=True):
+                st.warning("Direct edits disabled. Use steps below.")
+                st.subheader("1. Suggested Fix")
+                st.code(fix_code, language='python')
+                st.subheader("2. Apply Manually")
+                st.code("""git add app.py
+git commit -m "fix: AI suggestion"
+git push origin HEAD""", language="bash")
+    else:
+        st.info("No critical auto-fixes suggested.")
+
+    # --- Documentation Suggestions Section ---
+    doc_suggestions = extract_doc_suggestions(review_data['review'])
+    if doc_suggestions:
+        st.markdown("---")
+        st.subheader("Documentation Suggestions")
+        for idx, sug in enumerate(doc_suggestions, 1):
+            file_name = sug["file"]
+            content   = sug["content"]
+
+            with st.expander(f"{idx}. `{file_name}`", expanded=False):
+                st.markdown("**Suggested addition / update**")
+                preview = f"```markdown\n{content}\n```"
+                st.markdown(preview)
+
+                # One-click copy
+                copy_key = f"copy_doc_{idx}"
+                if st.button("Copy to Clipboard", key=copy_key):
+                    st.code(content, language="markdown")
+                    st.success("Copied! Paste it into the file manually or use the auto-PR button below.")
+
+                # Auto-PR for docs (optional)
+                if st.button("Create Docs PR", key=f"pr_doc_{idx}", help="Opens a PR that appends the suggestion"):
+                    with st.spinner("Creating Documentation PR…"):
+                        try:
+                            if gh is None:
+                                raise RuntimeError("apply_fix_to_github failed to import")
+                            pr = gh.create_pr_with_fix(
+                                repo=st.secrets.get("GITHUB_REPO", "your-username/your-repo"),
+                                branch=f"ai-doc-{int(time.time())}",
+                                file_path=file_name,
+                                old_code="",                     # we are *appending*
+                                new_code=content + "\n",
+                                commit_message=f"docs: update {file_name} (AI suggestion)",
+                                pr_title=f"Docs: AI-suggested update for `{file_name}`",
+                                pr_body=f"Automatically generated documentation update.\n\n**Suggested content**:\n```markdown\n{content}\n```",
+                                append=True
+                            )
+                            st.success(f"Docs PR created! [View]({pr['html_url']})")
+                        except Exception as e:
+                            st.error(f"Docs PR failed: {e}")
+    else:
+        st.info("**Documentation Suggestions**: None needed.")
+
+    st.markdown("---")
+    st.caption("CI/CD: This app auto-deploys to Streamlit Cloud on push to `main`.")
 
 def main():
     st.set_page_config(page_title="AI Code Review", layout="wide")
@@ -196,8 +670,10 @@ def main():
             keys_to_clear = [k for k in st.session_state.keys() if k.startswith('custom_guidelines')]
             for k in keys_to_clear:
                 del st.session_state[k]
+            # No explicit st.rerun(): the button click already ran this
+            # script with the state cleared, and rerunning again would
+            # discard the message below and re-pay the whole page render.
             st.success("Guidelines reset to default.")
-            st.rerun()
 
     if uploaded:
         guideline_text = load_guidelines(uploaded)
@@ -213,135 +689,35 @@ def main():
     else:
         st.success("Staged changes detected. Ready for review.")
         with st.expander("View Staged Diff", expanded=False):
-            st.code(diff_content, language='diff')
-
-        if st.button("🚀Review Code", type="primary", use_container_width=True):
-            with st.spinner(f"Reviewing with {LLM_MODEL}..."):
-                review_data = run_code_review(diff_content)
-
-            st.markdown("---")
-            
-            # COST MANAGEMENT: Display Resource Metrics (UPDATED)
-            col1, col2, col3, col4 = st.columns(4)
-
-            with col1:
-                st.metric("Review Time", f"{review_data['time']:.2f}s")
-            
-            with col2:
-                # Estimate tokens: 1 token is roughly 4 characters (for English text)
-                input_tokens = int(review_data['input_chars'] / 4) 
-                st.metric("Prompt Size (est.)", f"{input_tokens:,} tokens")
-
-            with col3:
-                output_tokens = int(review_data['output_chars'] / 4)
-                st.metric("Response Size (est.)", f"{output_tokens:,} tokens")
-                
-            with col4:
-                st.metric("Total Characters", f"{(review_data['input_chars'] + review_data['output_chars']):,}")
-                
-            st.markdown("---")
-            
-            st.subheader("LLM Review")
-            clean_review = review_data['review'].replace('[FIX_START]', '').replace('[FIX_END]', '')
-            st.markdown(clean_review)
-
-            # --- Auto-Fix Section ---
-            fix_code = extract_fixes(review_data['review'])
-            if fix_code:
-                st.markdown("---")
-                if 'show_fix' not in st.session_state:
-                    st.session_state.show_fix = False
-
-                col_apply, col_guide = st.columns([1, 1])
-                with col_apply:
-                    if st.button("Apply to GitHub (Auto-PR)", type="success", use_container_width=True):
-                        with st.spinner("Creating PR on GitHub..."):
-                            try:
-                                import apply_fix_to_github as gh
-
-                                # Extract added lines from diff
-                                diff_lines = diff_content.strip().split('\n')
-                                added_lines = [line[1:] for line in diff_lines if line.startswith('+') and not line.startswith('+++')]
-                                old_code = textwrap.dedent(''.join(added_lines)).strip()
-
-                                if not old_code:
-                                    st.error("Could not detect modified code block.")
-                                else:
-                                    pr = gh.create_pr_with_fix(
-                                        repo=st.secrets.get("GITHUB_REPO", "your-username/your-repo"),
-                                        branch=f"ai-fix-{int(time.time())}",
-                                        file_path="app.py",
-                                        old_code=old_code,
-                                        new_code=fix_code,
-                                        commit_message="fix: AI-suggested code improvement",
-                                        pr_title="AI Fix: Apply LLM suggestion",
-                                        pr_body=f"Automatically applied fix from AI code review.\n\n**Original diff**:\n```diff\n{diff_content}\n```",
-                                    )
-                                    pr_url = pr["html_url"]
-                                    st.success(f"PR created! [View on GitHub]({pr_url})")
-                            except Exception as e:
-                                st.error(f"Failed to create PR: {e}")
-
-                with col_guide:
-                    if st.button("Show Manual Guide"):
-                        st.session_state.show_fix = not st.session_state.show_fix
-
-                if st.session_state.show_fix:
-                    with st.expander("Manual Fix Guide", expanded=True):
-                        st.warning("Direct edits disabled. Use steps below.")
-                        st.subheader("1. Suggested Fix")
-                        st.code(fix_code, language='python')
-                        st.subheader("2. Apply Manually")
-                        st.code("""git add app.py
-git commit -m "fix: AI suggestion"
-git push origin HEAD""", language="bash")
-            else:
-                st.info("No critical auto-fixes suggested.")
-
-            # --- Documentation Suggestions Section ---
-            doc_suggestions = extract_doc_suggestions(review_data['review'])
-            if doc_suggestions:
-                st.markdown("---")
-                st.subheader("Documentation Suggestions")
-                for idx, sug in enumerate(doc_suggestions, 1):
-                    file_name = sug["file"]
-                    content   = sug["content"]
-
-                    with st.expander(f"{idx}. `{file_name}`", expanded=False):
-                        st.markdown("**Suggested addition / update**")
-                        preview = f"```markdown\n{content}\n```"
-                        st.markdown(preview)
-
-                        # One-click copy
-                        copy_key = f"copy_doc_{idx}"
-                        if st.button("Copy to Clipboard", key=copy_key):
-                            st.code(content, language="markdown")
-                            st.success("Copied! Paste it into the file manually or use the auto-PR button below.")
-
-                        # Auto-PR for docs (optional)
-                        if st.button("Create Docs PR", key=f"pr_doc_{idx}", help="Opens a PR that appends the suggestion"):
-                            with st.spinner("Creating Documentation PR…"):
-                                try:
-                                    import apply_fix_to_github as gh
-                                    pr = gh.create_pr_with_fix(
-                                        repo=st.secrets.get("GITHUB_REPO", "your-username/your-repo"),
-                                        branch=f"ai-doc-{int(time.time())}",
-                                        file_path=file_name,
-                                        old_code="",                     # we are *appending*
-                                        new_code=content + "\n",
-                                        commit_message=f"docs: update {file_name} (AI suggestion)",
-                                        pr_title=f"Docs: AI-suggested update for `{file_name}`",
-                                        pr_body=f"Automatically generated documentation update.\n\n**Suggested content**:\n```markdown\n{content}\n```",
-                                        append=True
-                                    )
-                                    st.success(f"Docs PR created! [View]({pr['html_url']})")
-                                except Exception as e:
-                                    st.error(f"Docs PR failed: {e}")
+            # Cap what goes through Pygments and over the WebSocket on every
+            # rerun; the full diff stays available as a download.
+            if len(diff_content) > MAX_DISPLAY_BYTES:
+                hidden = len(diff_content) - MAX_DISPLAY_BYTES
+                st.code(
+                    diff_content[:MAX_DISPLAY_BYTES]
+                    + f"\n[... {hidden:,} bytes hidden — download the full diff below ...]",
+                    language='diff'
+                )
+                st.download_button("Download full diff", diff_content, file_name="staged.diff")
             else:
-                st.info("**Documentation Suggestions**: None needed.")
+                st.code(diff_content, language='diff')
 
-            st.markdown("---")
-            st.caption("CI/CD: This app auto-deploys to Streamlit Cloud on push to `main`.")
+        force_refresh = st.checkbox(
+            "Force refresh",
+            help="Ignore the cached review for this diff and ask the LLM again."
+        )
+
+        diff_key = hashlib.sha256(diff_content.encode()).hexdigest()
+        if st.button("🚀Review Code", type="primary", use_container_width=True):
+            st.caption(f"Reviewing with {LLM_MODEL}...")
+            review_data = run_code_review(diff_content, force_refresh=force_refresh)
+            # Keep the result across reruns triggered by other widgets, so
+            # the panel survives without re-invoking the LLM.
+            st.session_state['review_data'] = review_data
+            st.session_state['review_key'] = diff_key
+            _render_review_panel(review_data, diff_content)
+        elif st.session_state.get('review_key') == diff_key:
+            _render_review_panel(st.session_state['review_data'], diff_content)
 
 if __name__ == "__main__":
     main()   
@@ -1,9 +1,69 @@
 # apply_fix_to_github.py
 import os
+import asyncio
+import base64
 import hmac
 import hashlib
+import httpx
 import requests
-from typing import Dict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Optional
+
+# One pooled session for all GitHub calls: reuses the TLS connection across
+# the 5+ sequential requests a PR creation makes (each fresh handshake costs
+# ~100-300 ms) and retries transient gateway errors with backoff.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
+# GitHub returns ETags on GETs; a revalidated 304 carries no body and does
+# not count against the rate limit, so repeat PR creations against the
+# same branch state get their lookups nearly free.
+_ETAG_CACHE: Dict[str, tuple] = {}
+
+def _get_json(url: str, headers: Dict, params: Optional[Dict] = None) -> Dict:
+    """GET returning JSON, revalidating via If-None-Match when possible."""
+    key = url if not params else url + "?" + repr(sorted(params.items()))
+    req_headers = dict(headers)
+    cached = _ETAG_CACHE.get(key)
+    if cached:
+        req_headers["If-None-Match"] = cached[0]
+    r = _SESSION.get(url, headers=req_headers, params=params)
+    if r.status_code == 304 and cached:
+        return cached[1]
+    r.raise_for_status()
+    body = r.json()
+    etag = r.headers.get("ETag")
+    if etag:
+        _ETAG_CACHE[key] = (etag, body)
+    return body
+
+def _decode_contents(content: Dict) -> Optional[bytes]:
+    """Inline file body from a GET /contents response, as raw bytes.
+
+    GitHub embeds the base64-encoded body for files under ~1 MB, which
+    saves the separate download_url round-trip. Staying in bytes skips
+    a UTF-8 decode/encode round-trip on potentially multi-MB bodies —
+    the snippet search and splice work on bytes directly. Returns None
+    when the body isn't inlined and the caller must fall back to
+    download_url.
+    """
+    if content.get("encoding") == "base64" and content.get("size", 0) <= 1_000_000:
+        return base64.b64decode(content["content"])
+    return None
+
 
 def create_pr_with_fix(
     repo: str,
@@ -30,12 +90,10 @@ def create_pr_with_fix(
     base_url = f"https://api.github.com/repos/{repo}"
 
     # 1. Get default branch SHA
-    r = requests.get(f"{base_url}/git/refs/heads/main", headers=headers)
-    r.raise_for_status()
-    main_sha = r.json()["object"]["sha"]
+    main_sha = _get_json(f"{base_url}/git/refs/heads/main", headers)["object"]["sha"]
 
     # 2. Create new branch
-    r = requests.post(
+    r = _SESSION.post(
         f"{base_url}/git/refs",
         headers=headers,
         json={"ref": f"refs/heads/{branch}", "sha": main_sha},
@@ -44,26 +102,26 @@ def create_pr_with_fix(
         raise Exception(f"Failed to create branch: {r.text}")
 
     # 3. Get current file content (to get blob SHA)
-    r = requests.get(f"{base_url}/contents/{file_path}", headers=headers, params={"ref": "main"})
-    r.raise_for_status()
-    content = r.json()
-    old_content = requests.get(content["download_url"]).text
+    content = _get_json(f"{base_url}/contents/{file_path}", headers, params={"ref": "main"})
+    old_bytes = _decode_contents(content)
+    if old_bytes is None:
+        old_bytes = _SESSION.get(content["download_url"], headers=headers).content
 
-    if old_code not in old_content:
+    old_code_bytes = old_code.encode("utf-8")
+    # One find() gives both the safety check and the splice offset —
+    # str.replace would rescan the whole body for a position we already
+    # know. A second hit means the snippet is ambiguous; refuse to guess.
+    idx = old_bytes.find(old_code_bytes)
+    if idx < 0:
         raise ValueError("Original code snippet not found in file. Cannot apply fix safely.")
+    if old_bytes.find(old_code_bytes, idx + 1) != -1:
+        raise ValueError("Code snippet appears more than once in file. Cannot apply fix safely.")
 
     # 4. Update file
-    new_content = old_content.replace(old_code, new_code, 1)  # Replace first occurrence
-    new_content_b64 = requests.post(
-        "https://api.github.com/markdown",
-        headers=headers,
-        json={"text": new_content, "mode": "gfm"},
-    ).text  # Just encode
+    new_bytes = old_bytes[:idx] + new_code.encode("utf-8") + old_bytes[idx + len(old_code_bytes):]
+    content_b64 = base64.b64encode(new_bytes).decode("ascii")
 
-    import base64
-    content_b64 = base64.b64encode(new_content.encode("utf-8")).decode("utf-8")
-
-    r = requests.put(
+    r = _SESSION.put(
         f"{base_url}/contents/{file_path}",
         headers=headers,
         json={
@@ -76,7 +134,7 @@ def create_pr_with_fix(
     r.raise_for_status()
 
     # 5. Create PR
-    r = requests.post(
+    r = _SESSION.post(
         f"{base_url}/pulls",
         headers=headers,
         json={
@@ -87,4 +145,98 @@ def create_pr_with_fix(
         },
     )
     r.raise_for_status()
-    return r.json()
\ No newline at end of file
+    return r.json()
+
+
+async def create_pr_with_fix_async(
+    repo: str,
+    branch: str,
+    file_path: str,
+    old_code: str,
+    new_code: str,
+    commit_message: str,
+    pr_title: str,
+    pr_body: str,
+) -> Dict:
+    """
+    Async variant of create_pr_with_fix for callers with an event loop.
+
+    The two independent GETs (base branch ref, file contents) go out
+    concurrently, and the raw-content download overlaps with branch
+    creation — on a high-RTT link that halves the pre-commit phase.
+    The remaining steps are order-dependent and stay sequential.
+    """
+    token = os.getenv("GITHUB_TOKEN")
+    if not token:
+        raise ValueError("GITHUB_TOKEN not found in environment")
+
+    headers = {
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+    base_url = f"https://api.github.com/repos/{repo}"
+
+    async with httpx.AsyncClient(headers=headers, timeout=30.0) as client:
+        ref_resp, contents_resp = await asyncio.gather(
+            client.get(f"{base_url}/git/refs/heads/main"),
+            client.get(f"{base_url}/contents/{file_path}", params={"ref": "main"}),
+        )
+        ref_resp.raise_for_status()
+        contents_resp.raise_for_status()
+        main_sha = ref_resp.json()["object"]["sha"]
+        content = contents_resp.json()
+
+        old_bytes = _decode_contents(content)
+        if old_bytes is None:
+            # Body too large to be inlined — overlap the download with
+            # branch creation as before.
+            branch_resp, download_resp = await asyncio.gather(
+                client.post(
+                    f"{base_url}/git/refs",
+                    json={"ref": f"refs/heads/{branch}", "sha": main_sha},
+                ),
+                client.get(content["download_url"]),
+            )
+            old_bytes = download_resp.content
+        else:
+            branch_resp = await client.post(
+                f"{base_url}/git/refs",
+                json={"ref": f"refs/heads/{branch}", "sha": main_sha},
+            )
+        if branch_resp.status_code != 201:
+            raise Exception(f"Failed to create branch: {branch_resp.text}")
+
+        old_code_bytes = old_code.encode("utf-8")
+        idx = old_bytes.find(old_code_bytes)
+        if idx < 0:
+            raise ValueError("Original code snippet not found in file. Cannot apply fix safely.")
+        if old_bytes.find(old_code_bytes, idx + 1) != -1:
+            raise ValueError("Code snippet appears more than once in file. Cannot apply fix safely.")
+
+        new_bytes = (
+            old_bytes[:idx] + new_code.encode("utf-8") + old_bytes[idx + len(old_code_bytes):]
+        )
+        content_b64 = base64.b64encode(new_bytes).decode("ascii")
+
+        r = await client.put(
+            f"{base_url}/contents/{file_path}",
+            json={
+                "message": commit_message,
+                "content": content_b64,
+                "sha": content["sha"],
+                "branch": branch,
+            },
+        )
+        r.raise_for_status()
+
+        r = await client.post(
+            f"{base_url}/pulls",
+            json={
+                "title": pr_title,
+                "head": branch,
+                "base": "main",
+                "body": pr_body,
+            },
+        )
+        r.raise_for_status()
+        return r.json()
\ No newline at end of file